@@ -4,15 +4,18 @@ Firmware Bundle-and-Protect Tool
 """
 
 import argparse
+import json
+import os
 import pathlib
 import struct
 
+from concurrent.futures import ThreadPoolExecutor
+
 from Crypto.Cipher import AES
-from Crypto.Hash import SHA256
 from Crypto.PublicKey import ECC
 from Crypto.Signature import DSS
 
-from Crypto.Util.Padding import pad, unpad
+from openssl import LIBCRYPTO, AESCipher, ECDSASigner, HashlibSHA256
 
 # crypto directory, where keys generated by bl_build are stored
 CRYPTO_DIR = (
@@ -29,47 +32,108 @@ MAX_FIRMWARE_SIZE = 30000
 # AES-256 key length
 AES_KEY_LEN = 32
 
+# raw ECDSA P-256 signature length at the start of the blob
+SIGNATURE_LEN = 64
 
-def protect_firmware(infile, outfile, version, message):
-    # Read firmware binary after it is compiled by bl_build
-    with open(infile, "rb") as infile:
-        firmware = infile.read()
+# version, firmware length and message length as little-endian shorts
+METADATA = struct.Struct("<HHH")
+METADATA_LEN = METADATA.size
+
+# bytes encrypted and hashed per step, a multiple of the AES block size
+CHUNK_SIZE = 4096
 
-    # check that message and firmware length within project description
-    # and that version can be packed as a short
-    assert version <= MAX_VERSION
-    assert len(message) <= MAX_MESSAGE_SIZE
-    assert len(firmware) <= MAX_FIRMWARE_SIZE
 
+def load_signer(priv_key):
+    # ECDSA signer, P-256 curve, for integrity and authenticity;
+    # system libcrypto when available, PyCryptodome otherwise
+    if LIBCRYPTO is not None:
+        return ECDSASigner(priv_key)
+    return DSS.new(ECC.import_key(priv_key), mode="fips-186-3")
+
+
+def load_secrets():
     # Extract keys from secret build output 32 bytes AES
     # then ECC private key is the rest of the file
     # Public key not needed for signing; not loaded
     with open(CRYPTO_DIR / "secret_build_output.txt", mode="rb") as secfile:
         aes_key = secfile.read(AES_KEY_LEN)
         priv_key = secfile.read()
-        priv_key = ECC.import_key(priv_key)
 
     # Extract initalization vector (IV) generated by bl_build
     with open(CRYPTO_DIR / "iv.txt", mode="rb") as ivfile:
         iv = ivfile.read()
 
-    # Pack version, length of firmware, and size into 3 little-endian shorts
-    # makes 6 byte metadata
-    metadata = struct.pack("<HHH", version, len(firmware), len(message))
+    return aes_key, iv, priv_key
+
+
+def protect_firmware_batch(items):
+    # Protect every (infile, outfile, version, message) in items, reading the
+    # keys and importing the private key only once for all of them
+    aes_key, iv, priv_key = load_secrets()
+
+    # Import the private key in the background while the firmware is encrypted
+    executor = ThreadPoolExecutor(max_workers=1)
+    signer_future = executor.submit(load_signer, priv_key)
+    executor.shutdown(wait=False)
+
+    for infile, outfile, version, message in items:
+        encrypt_and_sign(infile, outfile, version, message, aes_key, iv, signer_future)
+
+
+def protect_firmware(infile, outfile, version, message):
+    protect_firmware_batch([(infile, outfile, version, message)])
 
-    # AES-256 cipher, CBC
-    aes = AES.new(aes_key, AES.MODE_CBC, iv=iv)
 
-    # ECDSA signer, P-256 curve, for integrity and authenticity
-    signer = DSS.new(priv_key, mode="fips-186-3")
+def encrypt_and_sign(infile, outfile, version, message, aes_key, iv, signer_future):
+    # Read firmware binary after it is compiled by bl_build
+    with open(infile, "rb") as infile:
+        firmware = bytearray(os.fstat(infile.fileno()).st_size)
+        infile.readinto(firmware)
+
+    # check that message and firmware length within project description
+    # and that version can be packed as a short
+    assert version <= MAX_VERSION
+    assert len(message) <= MAX_MESSAGE_SIZE
+    assert len(firmware) <= MAX_FIRMWARE_SIZE
+
+    # AES-256 cipher, CBC, restarted from the IV for every firmware;
+    # system libcrypto when available
+    if LIBCRYPTO is not None:
+        aes = AESCipher(aes_key, iv)
+    else:
+        aes = AES.new(aes_key, AES.MODE_CBC, iv=iv)
+
+    # firmware and message, null-terminated and PKCS#7 padded into one buffer
+    msg = message.encode()
+    size = len(firmware) + len(msg) + 1
+    pad_len = AES.block_size - size % AES.block_size
+    plaintext = memoryview(bytearray(size + pad_len))
+    plaintext[: len(firmware)] = firmware
+    plaintext[len(firmware) : size - 1] = msg
+    plaintext[size:] = bytes((pad_len,)) * pad_len
+
+    # lay out signature, metadata and ciphertext in a single buffer
+    blob = bytearray(SIGNATURE_LEN + METADATA_LEN + len(plaintext))
+    view = memoryview(blob)
+
+    # Pack version, length of firmware, and size into 3 little-endian shorts
+    # makes 6 byte metadata, written in place after the signature
+    METADATA.pack_into(blob, SIGNATURE_LEN, version, len(firmware), len(message))
+
+    # SHA-256 of metadata plus ciphertext, hashed by OpenSSL
+    h = HashlibSHA256(view[SIGNATURE_LEN : SIGNATURE_LEN + METADATA_LEN])
 
-    # metadata plus aes of firmware and message, padded and null-terminated
-    # sign all of that and prepend signature
-    blob = metadata + aes.encrypt(pad(firmware + message.encode() + b"\x00", 16))
+    # aes of the padded plaintext, encrypted straight into the blob a chunk
+    # at a time; CBC state carries over between calls, and each chunk is
+    # hashed while it is still in cache
+    ciphertext = view[SIGNATURE_LEN + METADATA_LEN :]
+    for pos in range(0, len(plaintext), CHUNK_SIZE):
+        chunk = ciphertext[pos : pos + CHUNK_SIZE]
+        aes.encrypt(plaintext[pos : pos + CHUNK_SIZE], output=chunk)
+        h.update(chunk)
 
-    # signs SHA-256 hash
-    h = SHA256.new(blob)
-    blob = signer.sign(h) + blob
+    # signs the hash and fills in the signature
+    view[:SIGNATURE_LEN] = signer_future.result().sign(h)
 
     # write protected firmware blob into outfile
     with open(outfile, "wb") as outfile:
@@ -78,25 +142,33 @@ def protect_firmware(infile, outfile, version, message):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Firmware Update Tool")
+    parser.add_argument("--infile", help="Path to the firmware image to protect.")
+    parser.add_argument("--outfile", help="Filename for the output firmware.")
+    parser.add_argument("--version", help="Version number of this firmware.")
+    parser.add_argument("--message", help="Release message for this firmware.")
     parser.add_argument(
-        "--infile", help="Path to the firmware image to protect.", required=True
-    )
-    parser.add_argument(
-        "--outfile", help="Filename for the output firmware.", required=True
-    )
-    parser.add_argument(
-        "--version", help="Version number of this firmware.", required=True
-    )
-    parser.add_argument(
-        "--message", help="Release message for this firmware.", required=True
+        "--manifest",
+        help="JSON list of {infile, outfile, version, message} objects to protect "
+        "in one run, instead of the single-firmware arguments.",
     )
     args = parser.parse_args()
-    protect_firmware(
-        infile=args.infile,
-        outfile=args.outfile,
-        version=int(args.version),
-        message=args.message
-    )
+
+    if args.manifest is not None:
+        with open(args.manifest) as manifest:
+            entries = json.load(manifest)
+        protect_firmware_batch(
+            (entry["infile"], entry["outfile"], int(entry["version"]), entry["message"])
+            for entry in entries
+        )
+    elif None in (args.infile, args.outfile, args.version, args.message):
+        parser.error("--infile, --outfile, --version and --message are required")
+    else:
+        protect_firmware(
+            infile=args.infile,
+            outfile=args.outfile,
+            version=int(args.version),
+            message=args.message
+        )
 
 # sus impoter
 #                         ▁▃▄▅▆▆▇▇▇▇▆▅▄▃▁
@@ -13,25 +13,23 @@ A frame consists of two sections:
 """
 
 import argparse
+import binascii
+import mmap
+import os
 import pathlib
 import struct
+import sys
 import time
 import socket
 
-from util import UART0_PATH, UART1_PATH, UART2_PATH, print_hex, DomainSocketSerial
+from util import UART0_PATH, UART1_PATH, UART2_PATH, DomainSocketSerial
 
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import ECC
-from Crypto.Signature import DSS
-from pwn import *
+from openssl import LIBCRYPTO, ECDSAVerifier, HashlibSHA256
 
 
 # size of communication frame
 FRAME_SIZE = 256
 
-# size of header
-HEADER = 2
-
 # header types
 OK = b"O"
 ERROR = b"E"
@@ -41,105 +39,150 @@ META = b"M"
 FIRM = b"C"
 DONE = b"D"
 
+# OK as an integer, to check replies without building bytes objects
+OK_BYTE = OK[0]
+
+# little-endian frame length, as read by the bootloader
+FRAME_LENGTH = struct.Struct("<H")
+
+# version, firmware size and message length echoed by the bootloader
+METADATA_ECHO = struct.Struct("<HHH")
+
+# version and firmware size at the start of the metadata
+METADATA_HEADER = struct.Struct("<HH")
+
+# number of frames sent ahead of the bootloader's OKs
+WINDOW_SIZE = 4
+
+# seconds to wait for a response from the bootloader
+TIMEOUT = 5
+
 
 # crypto directory, where keys generated by bl_build are stored
 CRYPTO_DIRECTORY = (
     pathlib.Path(__file__).parent.parent.joinpath("bootloader/crypto").absolute()
 )
 
+# public key written by bl_build, resolved once
+ECC_KEY_PATH = str(CRYPTO_DIRECTORY / "ecc_public.raw")
+
+# verifiers for public keys already imported, keyed by path
+VERIFIER_CACHE = {}
+
+
+def load_verifier(path):
+    # Import the public key once and reuse it until the key file changes
+    mtime = os.stat(path).st_mtime_ns
+    cached = VERIFIER_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as fp:
+        raw_key = fp.read()
+
+    # Verifiers keep no per-message state, so one can be shared; OpenSSL's
+    # P-256 code when libcrypto is available, PyCryptodome otherwise
+    if LIBCRYPTO is not None:
+        verifier = ECDSAVerifier(raw_key)
+    else:
+        # Only imported here, as loading PyCryptodome's ECC slows startup
+        from Crypto.PublicKey import ECC
+        from Crypto.Signature import DSS
+
+        key = ECC.import_key(raw_key, curve_name="secp256r1")
+        verifier = DSS.new(key, "fips-186-3")
+    VERIFIER_CACHE[path] = (mtime, verifier)
+    return verifier
+
 
 def send_metadata(ser, metadata, debug=False):
     print("METADATA:")
     # Parse version information
-    version, size = struct.unpack("<HH", metadata[64:68])
+    version, size = METADATA_HEADER.unpack_from(metadata, 64)
     print(f"\tVersion: {version}\n\tSize: {size} bytes")
 
-    # Handshake with bootloader to send metadata
-    ser.write(META)
+    # Handshake with bootloader and send metadata in one write; the
+    # bootloader only reads the metadata once it has sent its OK
+    ser.writev([META, metadata])
+    print("\tSending metadata!")
     if debug:
         print("\tMETA packet sent!")
-    while ser.read(HEADER) != OK:
-        time.sleep(0.2)
+    wait_for_ok(ser)
     if debug:
         print("\tPacket accepted by bootloader!")
 
-    # Send metadata
-    ser.write(metadata)
-    print("\tSending metadata!")
-
-    time.sleep(0.2)
-
-    # Version
-    b_version = ser.read(2)
-    ## Version check
-    if b_version == ERROR:
-        raise RuntimeError("Invalid version request, aborting.")
-    # Version (cont.)
-    b_version = int(struct.unpack("<H", b_version)[0])
+    # Version, firmware size and message length are echoed back in one block
+    echo = ser.read(METADATA_ECHO.size)
+    if echo != metadata[64:70]:
+        raise RuntimeError("ERROR: Bootloader echoed metadata {}".format(repr(echo)))
+    b_version, b_size, b_mlength = METADATA_ECHO.unpack(echo)
     if debug:
         print(f"\tVersion echoed by bootloader: {b_version}")
-
-    time.sleep(0.2)
-
-    # Version size
-    b_size = bytes([])
-    while len(b_size) != 2:
-        b_size = ser.read(HEADER)
-    b_size = int(struct.unpack("<H", b_size)[0])
-    if debug:
         print(f"\tVersion size echoed by bootloader: {b_size}")
-
-    time.sleep(0.2)
-
-    # Message length
-    b_mlength = bytes([])
-    while len(b_mlength) != 2:
-        b_mlength = ser.read(HEADER)
-    b_mlength = int(struct.unpack("<H", b_mlength)[0])
-    if debug:
         print(f"\tMessage length echoed by bootloader: {b_mlength}")
 
     return True
 
 
-def send_firmware(ser, firmware, debug=False):
+def send_firmware(ser, firmware, debug=False, window=WINDOW_SIZE):
     print("FIRMWARE:")
 
-    # Handshake with bootloader to send firmware
-    time.sleep(1)
+    # Handshake with bootloader to send firmware. FIRM goes out alone: the
+    # bootloader checks the metadata only after echoing it and resets if it
+    # is rejected, so this OK is the only sign it was accepted. Frames sent
+    # before then would be read as commands by the reset bootloader
     ser.write(FIRM)
 
     if debug:
         print("\tFIRM packet sent!")
-    while ser.read(HEADER) != OK:
-        time.sleep(0.5)
+    wait_for_ok(ser)
     if debug:
         print("\tPacket accepted by bootloader!")
 
     print("\tSending firmware!")
 
-    # Send firmware in frames
-    for idx, frame_start in enumerate(range(0, len(firmware), FRAME_SIZE)):
-        data = firmware[frame_start : frame_start + FRAME_SIZE]
-
-        # Get length of data
-        length = len(data)
-
-        # Construct frame
-        frame = struct.pack(f"H{len(data)}s", length, data)
-
-        time.sleep(0.5)
-
-        # Send frame
-        send_frame(ser, frame, debug=debug)
-
+    # Debug output is collected per frame and written out in one go
+    debug_lines = [] if debug else None
+
+    # Send firmware in frames, keeping up to window frames unacknowledged.
+    # Frames go out in runs sliced from one buffer and their OKs are read
+    # together, so each syscall covers several frames
+    frames = memoryview(frame_firmware(firmware))
+    stride = FRAME_LENGTH.size + FRAME_SIZE
+    count = -(-len(firmware) // FRAME_SIZE)
+    sent = 0
+    acked = 0
+    try:
+        while acked < count:
+            # Top up the window in one write, the last frame together with
+            # the zero frame that follows it in the buffer
+            batch = min(window - (sent - acked), count - sent)
+            if batch:
+                stop = len(frames) if sent + batch == count else (sent + batch) * stride
+                ser.write(frames[sent * stride : stop])
+
+                if debug:
+                    for idx in range(sent, sent + batch):
+                        frame = frames[idx * stride : (idx + 1) * stride]
+                        debug_lines.append(binascii.hexlify(frame, b" ") + b"\n")
+                        debug_lines.append(
+                            f"Wrote frame {idx} ({len(frame)} bytes).\n".encode()
+                        )
+                sent += batch
+
+            # Wait for the oldest half of the window to be accepted
+            batch = min(max(window // 2, 1), sent - acked)
+            wait_for_ok(ser, count=batch, debug_lines=debug_lines)
+            acked += batch
+    finally:
         if debug:
-            print(f"Wrote frame {idx} ({len(frame)} bytes).")
-
-        time.sleep(0.2)
+            sys.stdout.flush()
+            sys.stdout.buffer.write(b"".join(debug_lines))
+            sys.stdout.flush()
 
-    # Send a zero frame
-    ser.write(struct.pack(">H", 0x0000))
+    # Send the zero frame on its own if there was no data to carry it
+    if not count:
+        ser.write(frames)
 
     # Wait for an OK from the bootloader
     resp = ser.read(1)
@@ -150,37 +193,131 @@ def send_firmware(ser, firmware, debug=False):
             )
         )
 
-    return ser
 
+def frame_firmware(firmware):
+    # Lay out every frame, length then data, in one contiguous buffer up
+    # front so the send loop only has to slice it; the buffer ends with the
+    # zero frame, left as zeroes
+    stride = FRAME_LENGTH.size + FRAME_SIZE
+    count = -(-len(firmware) // FRAME_SIZE)
+    full = len(firmware) // FRAME_SIZE
+    end = full * stride
+    frames = bytearray(len(firmware) + FRAME_LENGTH.size * (count + 1))
 
-def send_frame(ser, frame, debug=False):
-    # Write the frame
-    ser.write(frame)
-    if debug:
-        print_hex(frame)
+    # Every full frame has the same length field, so write each of its bytes
+    # into all of their headers with one strided assignment
+    for idx, byte in enumerate(FRAME_LENGTH.pack(FRAME_SIZE)):
+        frames[idx:end:stride] = bytes((byte,)) * full
 
-    # Wait for an OK from the bootloader
-    time.sleep(0.4)
+    # Slice data through a view, whether the caller passed bytes or a view
+    firmware = memoryview(firmware)
 
-    resp = ser.read(1)
+    positions = range(FRAME_LENGTH.size, end, stride)
+    for pos, start in zip(positions, range(0, full * FRAME_SIZE, FRAME_SIZE)):
+        frames[pos : pos + FRAME_SIZE] = firmware[start : start + FRAME_SIZE]
 
-    time.sleep(0.2)
+    # A short last frame carries its own length
+    tail = firmware[full * FRAME_SIZE :]
+    if tail:
+        FRAME_LENGTH.pack_into(frames, end, len(tail))
+        frames[end + FRAME_LENGTH.size : end + FRAME_LENGTH.size + len(tail)] = tail
 
-    if resp != OK:
+    return frames
+
+
+def wait_for_ok(ser, count=1, debug_lines=None):
+    # Wait for count OKs from the bootloader, bounded by the socket timeout
+    resp = ser.read(count)
+
+    if len(resp) != count or resp.count(OK_BYTE) != count:
         raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
+    if debug_lines is not None:
+        debug_lines.extend("Resp: {}\n".format(byte).encode() for byte in resp)
+
+
+def verify_blob(blob, debug=False):
+    # Parse firmware blob
+    signature = bytes(blob[0:64])
+    metadata = blob[64:70]
+    firmware = blob[70:]
+
+    # Check for integrity compromise using SHA hash
+    hasher = HashlibSHA256()
+    hasher.update(metadata)
+    hasher.update(firmware)
     if debug:
-        print("Resp: {}".format(ord(resp)))
+        hasherd = HashlibSHA256(metadata)
+        print("Metadata-only SHA256 hash: ", hasherd.hexdigest())
+        print("Complete SHA256 hash: ", hasher.hexdigest())
+
+    # Check for integrity compromise using ECC public key signature
+    verifier = load_verifier(ECC_KEY_PATH)
+    try:
+        verifier.verify(hasher, signature)
+    except ValueError:
+        return False
+    return True
+
+
+def map_firmware(path):
+    # Map a firmware blob read-only; the mapping is released once the views
+    # into it are dropped
+    with open(path, "rb") as fp:
+        firmware_blob = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # The blob is hashed front to back, so have the kernel read ahead of
+    # the hash instead of faulting pages in one at a time
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        firmware_blob.madvise(mmap.MADV_SEQUENTIAL)
+        firmware_blob.madvise(mmap.MADV_WILLNEED)
+
+    return firmware_blob
 
 
-def update(ser, infile, debug):
-    response = None
+def verify_one(path):
+    # Verify a protected firmware image on disk without a bootloader
+    try:
+        firmware_blob = map_firmware(path)
+    except (OSError, ValueError):
+        # Missing, unreadable or empty file
+        return False
+    return verify_blob(memoryview(firmware_blob))
+
+
+def verify_batch(paths):
+    # Images are independent, so verify them across a process pool; each
+    # worker imports the public key once and reuses it for its share.
+    # multiprocessing is only needed here, so updates don't pay to import it
+    from multiprocessing import Pool
+
+    with Pool() as pool:
+        return pool.map(verify_one, paths)
+
+
+def update(ser, infile, debug, window=WINDOW_SIZE):
+    # Map firmware blob; it stays mapped until the update finishes. An
+    # empty file cannot be mapped, and cannot carry a valid signature either
+    try:
+        firmware_blob = map_firmware(infile)
+    except ValueError:
+        raise RuntimeError("Invalid signature, aborting.") from None
+
+    # Parse firmware blob, slicing views rather than copies
+    blob = memoryview(firmware_blob)
+    firmware = blob[70:]
 
-    # Read firmware blob
-    with open(infile, "rb") as fp:
-        firmware_blob = fp.read()
+    # Check integrity and authenticity before touching the bootloader so a
+    # bad image fails fast
+    if debug:
+        print("\tVerifying firmware data!")
+    if not verify_blob(blob, debug=debug):
+        raise RuntimeError("Invalid signature, aborting.")
+    print("\tSignature verified on the client.")
 
     print("Connected!")
 
+    # Give the emulated bootloader time to come up; every exchange after
+    # this blocks on the bootloader's replies instead of sleeping
     time.sleep(3)
 
     print("UPDATE:")
@@ -189,43 +326,17 @@ def update(ser, infile, debug):
         print("\tPacket sent!")
 
     # Wait for an OK from the bootloader
-    while response != OK:
-        response = ser.read(HEADER)
+    wait_for_ok(ser)
     if debug:
         print("\tPacket accepted by bootloader!")
 
-    # Parse firmware blob
-    signature = firmware_blob[0:64]
-    metadata = firmware_blob[64:70]
-    firmware = firmware_blob[70:]
-
-    # Check for integrity compromise using SHA hash
-    if debug:
-        print("\tVerifying firmware data!")
-    hasher = SHA256.new(metadata + firmware)
-    hasherd = SHA256.new(metadata)
-    if debug:
-        print("Metadata-only SHA256 hash: ", hasherd.hexdigest())
-        print("Complete SHA256 hash: ", hasher.hexdigest())
-
-    # Check for integrity compromise using ECC public key signature
-    key = None
-    with open(CRYPTO_DIRECTORY / "ecc_public.raw", "rb") as fp:
-        key = ECC.import_key(fp.read(), curve_name="secp256r1")
-    verifier = DSS.new(key, "fips-186-3")
-    try:
-        verifier.verify(hasher, signature)
-        print("\tSignature verified on the client.")
-    except ValueError:
-        raise RuntimeError("Invalid signature, aborting.")
-
     # Proceed to sending data.
 
     # Send metadata
-    send_metadata(ser, signature + metadata, debug=debug)
+    send_metadata(ser, blob[0:70], debug=debug)
 
     # Send firmware
-    send_firmware(ser, firmware, debug=debug)
+    send_firmware(ser, firmware, debug=debug, window=window)
     print("\tDone writing firmware.")
 
     # Want to boot?
@@ -249,8 +360,33 @@ if __name__ == "__main__":
         "--debug", help="Enable debugging messages.", action="store_true", default=False
     )
 
+    parser.add_argument(
+        "--window",
+        help="Number of frames to send ahead of the bootloader's OKs once it "
+        "has accepted FIRM; 1 waits for each frame to be accepted before "
+        "sending the next.",
+        type=int,
+        default=WINDOW_SIZE,
+    )
+
+    parser.add_argument(
+        "--verify",
+        help="Only check the signatures of these protected firmware images.",
+        nargs="+",
+        metavar="FIRMWARE",
+    )
+
     args = parser.parse_args()
 
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    if args.verify is not None:
+        results = verify_batch(args.verify)
+        for path, valid in zip(args.verify, results):
+            print(f"{path}: {'verified' if valid else 'INVALID'}")
+        sys.exit(0 if all(results) else 1)
+
     uart0_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     uart0_sock.connect(UART0_PATH)
 
@@ -259,6 +395,7 @@ if __name__ == "__main__":
     uart1_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     uart1_sock.connect(UART1_PATH)
     uart1 = DomainSocketSerial(uart1_sock)
+    uart1.timeout = TIMEOUT
 
     time.sleep(0.2)
 
@@ -269,6 +406,6 @@ if __name__ == "__main__":
     uart2_sock.close()
     uart0_sock.close()
 
-    update(ser=uart1, infile=args.firmware, debug=args.debug)
+    update(ser=uart1, infile=args.firmware, debug=args.debug, window=args.window)
 
     uart1_sock.close()
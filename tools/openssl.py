@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+OpenSSL Bindings
+
+Thin ctypes wrappers around the system libcrypto so AES-256-CBC and
+ECDSA P-256 signing and verification run on OpenSSL's AES-NI/assembly code
+paths. The classes mirror the PyCryptodome objects they replace so callers
+can use either one.
+
+LIBCRYPTO is None when no usable libcrypto is found; callers then fall back
+to PyCryptodome. HashlibSHA256 needs no libcrypto and works with either.
+"""
+
+import ctypes
+import hashlib
+
+# AES block size in bytes
+BLOCK_SIZE = 16
+
+# byte length of each of r and s in a P-256 signature
+P256_SCALAR_LEN = 32
+
+# DER SubjectPublicKeyInfo header for an uncompressed P-256 point
+P256_SPKI_PREFIX = bytes.fromhex("3059301306072a8648ce3d020106082a8648ce3d030107034200")
+
+# library names to try, newest first, before searching for one
+LIBCRYPTO_NAMES = (
+    "libcrypto.so.3",
+    "libcrypto.so.1.1",
+)
+
+# (name, restype, argtypes) of every libcrypto function used below
+PROTOTYPES = (
+    ("EVP_aes_256_cbc", ctypes.c_void_p, ()),
+    ("EVP_CIPHER_CTX_new", ctypes.c_void_p, ()),
+    ("EVP_CIPHER_CTX_free", None, (ctypes.c_void_p,)),
+    ("EVP_CIPHER_CTX_set_padding", ctypes.c_int, (ctypes.c_void_p, ctypes.c_int)),
+    (
+        "EVP_EncryptInit_ex",
+        ctypes.c_int,
+        (
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+        ),
+    ),
+    (
+        "EVP_EncryptUpdate",
+        ctypes.c_int,
+        (
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_int),
+            ctypes.c_void_p,
+            ctypes.c_int,
+        ),
+    ),
+    ("BIO_new_mem_buf", ctypes.c_void_p, (ctypes.c_char_p, ctypes.c_int)),
+    ("BIO_free", ctypes.c_int, (ctypes.c_void_p,)),
+    (
+        "PEM_read_bio_PrivateKey",
+        ctypes.c_void_p,
+        (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p),
+    ),
+    ("EVP_PKEY_free", None, (ctypes.c_void_p,)),
+    ("EVP_PKEY_CTX_new", ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_void_p)),
+    ("EVP_PKEY_CTX_free", None, (ctypes.c_void_p,)),
+    (
+        "d2i_PUBKEY",
+        ctypes.c_void_p,
+        (ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_long),
+    ),
+    ("EVP_PKEY_sign_init", ctypes.c_int, (ctypes.c_void_p,)),
+    ("EVP_PKEY_verify_init", ctypes.c_int, (ctypes.c_void_p,)),
+    (
+        "EVP_PKEY_verify",
+        ctypes.c_int,
+        (
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_size_t,
+            ctypes.c_char_p,
+            ctypes.c_size_t,
+        ),
+    ),
+    (
+        "EVP_PKEY_sign",
+        ctypes.c_int,
+        (
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_size_t),
+            ctypes.c_char_p,
+            ctypes.c_size_t,
+        ),
+    ),
+)
+
+
+def open_libcrypto(name):
+    try:
+        lib = ctypes.CDLL(name)
+        for func, restype, argtypes in PROTOTYPES:
+            getattr(lib, func).restype = restype
+            getattr(lib, func).argtypes = argtypes
+    except (OSError, AttributeError):
+        # Library missing or too old to have the functions we need
+        return None
+    return lib
+
+
+def load_libcrypto():
+    for name in LIBCRYPTO_NAMES:
+        lib = open_libcrypto(name)
+        if lib is not None:
+            return lib
+
+    # find_library spawns helper processes, so it is only worth importing
+    # and running when none of the usual names load
+    import ctypes.util
+
+    name = ctypes.util.find_library("crypto")
+    return open_libcrypto(name) if name is not None else None
+
+
+LIBCRYPTO = load_libcrypto()
+
+
+def check(ret):
+    # OpenSSL returns 1 (or a non-NULL pointer) on success
+    if not ret or ret < 0:
+        raise ValueError("libcrypto call failed")
+    return ret
+
+
+def as_pointer(data):
+    # Pass writable buffers without copying; bytes are passed as-is
+    if isinstance(data, bytes):
+        return data
+    try:
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    except TypeError:
+        return bytes(data)
+
+
+def der_to_raw(der):
+    # ECDSA-Sig-Value ::= SEQUENCE { r INTEGER, s INTEGER }; P-256 signatures
+    # are always short enough for single-byte DER lengths
+    raw = b""
+    pos = 2
+    for _ in range(2):
+        length = der[pos + 1]
+        value = der[pos + 2 : pos + 2 + length]
+        raw += value.lstrip(b"\x00").rjust(P256_SCALAR_LEN, b"\x00")
+        pos += 2 + length
+    return raw
+
+
+def raw_to_der(raw):
+    # Inverse of der_to_raw: r || s back into an ECDSA-Sig-Value
+    if len(raw) != 2 * P256_SCALAR_LEN:
+        raise ValueError("The signature is not authentic (length)")
+
+    body = b""
+    for value in (raw[:P256_SCALAR_LEN], raw[P256_SCALAR_LEN:]):
+        value = value.lstrip(b"\x00") or b"\x00"
+        if value[0] & 0x80:
+            value = b"\x00" + value
+        body += bytes((0x02, len(value))) + value
+    return bytes((0x30, len(body))) + body
+
+
+class HashlibSHA256:
+    """hashlib SHA-256 usable wherever PyCryptodome's SHA256 is expected."""
+
+    # DSS checks the OID before signing or verifying
+    oid = "2.16.840.1.101.3.4.2.1"
+    digest_size = 32
+
+    def __init__(self, data=b""):
+        self.hasher = hashlib.sha256(data)
+
+    def update(self, data):
+        self.hasher.update(data)
+
+    def digest(self):
+        return self.hasher.digest()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class AESCipher:
+    """AES-256-CBC encryptor with the interface of PyCryptodome's CBC cipher."""
+
+    def __init__(self, key, iv):
+        self.ctx = check(LIBCRYPTO.EVP_CIPHER_CTX_new())
+        check(
+            LIBCRYPTO.EVP_EncryptInit_ex(
+                self.ctx, LIBCRYPTO.EVP_aes_256_cbc(), None, key, iv
+            )
+        )
+
+        # Callers pad the plaintext themselves, as with PyCryptodome
+        check(LIBCRYPTO.EVP_CIPHER_CTX_set_padding(self.ctx, 0))
+
+    def encrypt(self, plaintext, output=None):
+        if len(plaintext) % BLOCK_SIZE:
+            raise ValueError("Data must be padded to 16 byte boundary in CBC mode")
+
+        out = bytearray(len(plaintext)) if output is None else output
+        out_len = ctypes.c_int(0)
+        check(
+            LIBCRYPTO.EVP_EncryptUpdate(
+                self.ctx,
+                as_pointer(out),
+                ctypes.byref(out_len),
+                as_pointer(plaintext),
+                len(plaintext),
+            )
+        )
+        return bytes(out) if output is None else None
+
+    def __del__(self):
+        if getattr(self, "ctx", None):
+            LIBCRYPTO.EVP_CIPHER_CTX_free(self.ctx)
+
+
+class ECDSASigner:
+    """ECDSA P-256 signer with the interface of PyCryptodome's fips-186-3 DSS."""
+
+    def __init__(self, pem_key):
+        bio = check(LIBCRYPTO.BIO_new_mem_buf(pem_key, len(pem_key)))
+        try:
+            self.pkey = check(LIBCRYPTO.PEM_read_bio_PrivateKey(bio, None, None, None))
+        finally:
+            LIBCRYPTO.BIO_free(bio)
+
+    def sign(self, msg_hash):
+        # Sign the finished digest; returns r || s like DSS does
+        digest = msg_hash.digest()
+        ctx = check(LIBCRYPTO.EVP_PKEY_CTX_new(self.pkey, None))
+        try:
+            check(LIBCRYPTO.EVP_PKEY_sign_init(ctx))
+            sig_len = ctypes.c_size_t(0)
+            check(
+                LIBCRYPTO.EVP_PKEY_sign(
+                    ctx, None, ctypes.byref(sig_len), digest, len(digest)
+                )
+            )
+            der = ctypes.create_string_buffer(sig_len.value)
+            check(
+                LIBCRYPTO.EVP_PKEY_sign(
+                    ctx, der, ctypes.byref(sig_len), digest, len(digest)
+                )
+            )
+        finally:
+            LIBCRYPTO.EVP_PKEY_CTX_free(ctx)
+        return der_to_raw(der.raw[: sig_len.value])
+
+    def __del__(self):
+        if getattr(self, "pkey", None):
+            LIBCRYPTO.EVP_PKEY_free(self.pkey)
+
+
+class ECDSAVerifier:
+    """ECDSA P-256 verifier with the interface of PyCryptodome's fips-186-3 DSS."""
+
+    def __init__(self, raw_key):
+        # raw_key is the uncompressed point bl_build exports
+        der = P256_SPKI_PREFIX + raw_key
+        self.pkey = check(
+            LIBCRYPTO.d2i_PUBKEY(None, ctypes.byref(ctypes.c_char_p(der)), len(der))
+        )
+
+    def verify(self, msg_hash, signature):
+        # Raises ValueError if signature (r || s) does not match the digest
+        digest = msg_hash.digest()
+        der = raw_to_der(bytes(signature))
+        ctx = check(LIBCRYPTO.EVP_PKEY_CTX_new(self.pkey, None))
+        try:
+            check(LIBCRYPTO.EVP_PKEY_verify_init(ctx))
+            status = LIBCRYPTO.EVP_PKEY_verify(ctx, der, len(der), digest, len(digest))
+        finally:
+            LIBCRYPTO.EVP_PKEY_CTX_free(ctx)
+        if status != 1:
+            raise ValueError("The signature is not authentic")
+
+    def __del__(self):
+        if getattr(self, "pkey", None):
+            LIBCRYPTO.EVP_PKEY_free(self.pkey)
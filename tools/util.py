@@ -13,11 +13,30 @@ class DomainSocketSerial:
     def __init__(self, ser_socket: socket.socket):
         self.ser_socket = ser_socket
     
+    @property
+    def timeout(self) -> float:
+        return self.ser_socket.gettimeout()
+
+    @timeout.setter
+    def timeout(self, timeout: float):
+        self.ser_socket.settimeout(timeout)
+
     def read(self, length: int) -> bytes:
         if length < 1:
             raise ValueError("Read length must be at least 1 byte")
-        
-        return self.ser_socket.recv(length)
+
+        # Like pyserial, block until all bytes arrive; only a closed socket
+        # returns short, and the timeout raises socket.timeout. Partial
+        # reads land in one buffer behind a cursor instead of being joined
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            count = self.ser_socket.recv_into(view[received:])
+            if not count:
+                break
+            received += count
+        return bytes(view[:received])
     
     def readline(self) -> bytes:
         line = b""
@@ -31,7 +50,14 @@ class DomainSocketSerial:
         return line
 
     def write(self, data: bytes):
-        self.ser_socket.send(data)
+        # send() may take only part of a large buffer
+        self.ser_socket.sendall(data)
+
+    def writev(self, buffers: list):
+        # Scatter-gather write: one sendmsg call for all buffers
+        sent = self.ser_socket.sendmsg(buffers)
+        if sent < sum(len(buf) for buf in buffers):
+            self.ser_socket.sendall(b"".join(buffers)[sent:])
 
     def close(self):
         self.ser_socket.close()